@@ -1,12 +1,14 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import datetime
 from dateutil.relativedelta import relativedelta
 import uuid
 from streamlit_calendar import calendar
+import bisect
 from collections import Counter
 from pathlib import Path
-import pytz
+from zoneinfo import ZoneInfo
 
 # --- Page Config ---
 st.set_page_config(page_title="献血カレンダー", page_icon="💉", layout="wide")
@@ -14,17 +16,40 @@ st.set_page_config(page_title="献血カレンダー", page_icon="💉", layout=
 # --- Session State Initialization ---
 def init_session_state():
     if "history" not in st.session_state:
-        st.session_state.history = []
+        # Records keyed by their uuid so event lookup/update/delete are O(1).
+        st.session_state.history = load_history(HISTORY_PATH.stat().st_mtime) if HISTORY_PATH.exists() else {}
+        # The same record objects in chronological order, kept sorted at
+        # mutation time so check_availability never re-sorts per click.
+        st.session_state.history_sorted = sorted(st.session_state.history.values(), key=lambda r: r["start"])
+    if "history_version" not in st.session_state:
+        st.session_state.history_version = 0
     if "calendar_view_date" not in st.session_state:
         st.session_state.calendar_view_date = datetime.date.today().strftime("%Y-%m-%d")
 
-init_session_state()
-
 # --- Constants & Data Definitions ---
 ALL_TYPES = ["400ml全血", "200ml全血", "成分献血"]
 MAX_VOLUME = {"男性": 1200, "女性": 800}
+_VOL = {"200ml全血": 200, "400ml全血": 400}
+AGE_RANGES = {
+    "200ml全血": {"男性": (16, 69), "女性": (16, 69)},
+    "400ml全血": {"男性": (17, 69), "女性": (18, 69)},
+    "成分献血": {"男性": (18, 69), "女性": (18, 69)},
+}
+# Week-based waiting periods are exact day counts, so the C-implemented
+# timedelta is used instead of constructing a relativedelta per check.
+WHOLEBLOOD_WAIT = {
+    ("400ml全血", "男性"): datetime.timedelta(weeks=12),
+    ("400ml全血", "女性"): datetime.timedelta(weeks=16),
+    ("200ml全血", "男性"): datetime.timedelta(weeks=4),
+    ("200ml全血", "女性"): datetime.timedelta(weeks=4),
+}
+WHOLEBLOOD_TO_COMPONENT_WAIT = datetime.timedelta(weeks=8)
+COMPONENT_WAIT = datetime.timedelta(weeks=2)
 today = datetime.date.today()
+JST = ZoneInfo("Asia/Tokyo")
 LOCATIONS_CSV_PATH = Path("locations.csv")
+HISTORY_PATH = Path("history.parquet")
+HISTORY_COLUMNS = ["id", "title", "start", "location", "notes", "color"]
 
 REGIONS = {
     "北海道": ["北海道"],
@@ -51,16 +76,53 @@ def load_locations():
         csv_path = LOCATIONS_CSV_PATH
 
     try:
-        df = pd.read_csv(csv_path)
-        for col in ["name", "latitude", "longitude", "prefecture"]:
-            if col not in df.columns:
-                st.error(f"locations.csvに必須の列 '{col}' がありません。")
-                return pd.DataFrame()
-        df.fillna({"prefecture": "不明"}, inplace=True)
-        return df
+        # Only the displayed columns, with an explicit schema: float32 is
+        # plenty for display-only coordinates and halves the map buffer.
+        df = pd.read_csv(csv_path,
+                         usecols=["name", "latitude", "longitude", "prefecture"],
+                         dtype={"name": "string", "prefecture": "string",
+                                "latitude": "float32", "longitude": "float32"})
+    except ValueError:
+        # read_csv raises when a column in usecols is missing.
+        st.error("locations.csvに必須の列（name, latitude, longitude, prefecture）がありません。")
+        return pd.DataFrame()
     except Exception as e:
         st.error(f"locations.csvの読み込みに失敗しました: {e}")
         return pd.DataFrame()
+    df["prefecture"] = df["prefecture"].fillna("不明")
+    # Category codes make the prefecture groupby cheaper than raw strings.
+    df["prefecture"] = df["prefecture"].astype("category")
+    return df
+
+@st.cache_data
+def load_history(mtime):
+    # Keyed on the file's mtime so a new session sees writes made by
+    # an earlier one instead of a stale cache entry.
+    df = pd.read_parquet(HISTORY_PATH)
+    records = df.to_dict("records")
+    for r in records:
+        r["date_obj"] = datetime.date.fromisoformat(r["start"])
+    return {r["id"]: r for r in records}
+
+def save_history():
+    records = [{k: r[k] for k in HISTORY_COLUMNS} for r in st.session_state.history.values()]
+    pd.DataFrame(records, columns=HISTORY_COLUMNS).to_parquet(HISTORY_PATH)
+
+@st.cache_data
+def prefecture_rooms(df):
+    # Static prefecture -> room-name mapping; built once and reused so the
+    # per-prefecture rendering loop never filters the full DataFrame.
+    return {pref: g["name"].tolist() for pref, g in df.groupby("prefecture")}
+
+@st.cache_data
+def regions_present(df):
+    # REGIONS trimmed to prefectures that actually have rooms, so the render
+    # loop never builds expanders for empty regions.
+    present = set(df["prefecture"].unique())
+    trimmed = {region: [p for p in prefs if p in present] for region, prefs in REGIONS.items()}
+    return {region: prefs for region, prefs in trimmed.items() if prefs}
+
+init_session_state()
 
 # --- Sidebar ---
 st.sidebar.title("献血記録手帳")
@@ -72,50 +134,73 @@ gender = st.sidebar.radio("🚻 性別", ["男性", "女性"])
 st.sidebar.markdown("---")
 
 # --- Business Logic ---
-def get_volume(donation_type):
-    if donation_type == "200ml全血": return 200
-    if donation_type == "400ml全血": return 400
-    return 0
-
 def check_availability(target_date, history, gender, birthday):
+    # history must already be in chronological order (the history_sorted
+    # invariant maintained at the mutation sites).
+    for h in history:
+        # Legacy records created before "date_obj" was stored at ingest.
+        if "date_obj" not in h:
+            h["date_obj"] = datetime.date.fromisoformat(h["start"])
+    # Availability only depends on each record's date and type; a sorted
+    # (date, title) tuple is a hashable fingerprint st.cache_data can key on.
+    fingerprint = tuple((h["date_obj"], h["title"]) for h in history)
+    return _check_availability_cached(target_date, fingerprint, gender, birthday)
+
+@st.cache_data
+def _check_availability_cached(target_date, history_tuple, gender, birthday):
     results = {}
-    age_on_date = relativedelta(target_date, birthday).years
-    sorted_history = sorted(history, key=lambda x: x['start'])
-    donations_before_target = [h for h in sorted_history if datetime.datetime.strptime(h['start'], "%Y-%m-%d").date() < target_date]
-    last_donation = donations_before_target[-1] if donations_before_target else None
+    # Whole years between birthday and target_date without building a
+    # relativedelta: subtract one if the birthday hasn't come round yet.
+    # A Feb 29 birthday counts as Feb 28 in non-leap years, matching the
+    # previous relativedelta(...).years behaviour.
+    birth_month, birth_day = birthday.month, birthday.day
+    if birth_month == 2 and birth_day == 29:
+        year = target_date.year
+        if year % 4 or (year % 100 == 0 and year % 400):
+            birth_day = 28
+    age_on_date = target_date.year - birthday.year - ((target_date.month, target_date.day) < (birth_month, birth_day))
+
+    # Single sweep over the (sorted) history before target_date: the last
+    # donation, the earliest whole-blood donation inside the 1-year window
+    # and the whole-blood volume in that window all fall out of one pass.
+    window_start = target_date - relativedelta(years=1)
+    last_date = None
+    last_title = None
+    first_wholeblood_in_window = None
+    volume_in_year = 0
+    for donation_date, title in history_tuple:
+        if donation_date >= target_date:
+            break
+        last_date, last_title = donation_date, title
+        if "全血" in title and donation_date >= window_start:
+            if first_wholeblood_in_window is None:
+                first_wholeblood_in_window = donation_date
+            if donation_date > window_start:
+                volume_in_year += _VOL.get(title, 0)
 
     for don_type in ALL_TYPES:
-        is_age_ok = False
-        if don_type == "200ml全血" and 16 <= age_on_date <= 69: is_age_ok = True
-        if don_type == "400ml全血" and ((gender == "男性" and 17 <= age_on_date <= 69) or (gender == "女性" and 18 <= age_on_date <= 69)): is_age_ok = True
-        if don_type == "成分献血" and 18 <= age_on_date <= 69: is_age_ok = True
-        if not is_age_ok:
+        age_min, age_max = AGE_RANGES[don_type][gender]
+        if not (age_min <= age_on_date <= age_max):
             results[don_type] = {"available": False, "reason": "年齢制限"}
             continue
 
-        if last_donation:
-            last_date = datetime.datetime.strptime(last_donation['start'], "%Y-%m-%d").date()
+        if last_title:
             next_available = last_date
-            if "全血" in last_donation['title']:
-                if don_type == "成分献血": next_available += relativedelta(weeks=8)
-                elif last_donation['title'] == "400ml全血": next_available += relativedelta(weeks=12 if gender == "男性" else 16)
-                elif last_donation['title'] == "200ml全血": next_available += relativedelta(weeks=4)
-            elif "成分" in last_donation['title']:
-                next_available += relativedelta(weeks=2)
+            if "全血" in last_title:
+                if don_type == "成分献血":
+                    next_available += WHOLEBLOOD_TO_COMPONENT_WAIT
+                else:
+                    next_available += WHOLEBLOOD_WAIT.get((last_title, gender), datetime.timedelta(0))
+            elif "成分" in last_title:
+                next_available += COMPONENT_WAIT
             if target_date < next_available:
                 results[don_type] = {"available": False, "reason": "献血間隔", "next": next_available.strftime("%Y-%m-%d")}
                 continue
 
         if "全血" in don_type:
-            window_start = target_date - relativedelta(years=1)
-            relevant_history = [h for h in sorted_history if window_start < datetime.datetime.strptime(h['start'], "%Y-%m-%d").date() < target_date and "全血" in h['title']]
-            volume_in_year = sum(get_volume(h['title']) for h in relevant_history)
-            
-            if volume_in_year + get_volume(don_type) > MAX_VOLUME[gender]:
-                donations_in_window = [h for h in sorted_history if (target_date - relativedelta(years=1)) <= datetime.datetime.strptime(h['start'], "%Y-%m-%d").date() < target_date and "全血" in h['title']]
-                if donations_in_window:
-                    first_donation_in_window = min(donations_in_window, key=lambda x: x['start'])
-                    block_lift_date = datetime.datetime.strptime(first_donation_in_window['start'], "%Y-%m-%d").date() + relativedelta(years=1)
+            if volume_in_year + _VOL.get(don_type, 0) > MAX_VOLUME[gender]:
+                if first_wholeblood_in_window:
+                    block_lift_date = first_wholeblood_in_window + relativedelta(years=1)
                     results[don_type] = {"available": False, "reason": "年間総採血量上限", "next": block_lift_date.strftime("%Y-%m-%d")}
                     continue
         
@@ -136,11 +221,12 @@ def render_calendar_view():
         
         if not available_types:
             st.sidebar.warning("この日時に追加できる献血種別はありません。")
+            reasons = []
             for don_type, result in sorted(availability.items()):
                 if not result["available"]:
-                    reason = result["reason"]
                     next_date_info = f" (次回可能: {result['next']})" if "next" in result else ""
-                    st.sidebar.error(f"**{don_type}:** {reason}{next_date_info}")
+                    reasons.append(f"**{don_type}:** {result['reason']}{next_date_info}")
+            st.sidebar.error("\n\n".join(reasons))
             return
 
         with st.sidebar.form("donation_form", clear_on_submit=True):
@@ -155,8 +241,11 @@ def render_calendar_view():
                     return
                 
                 color = "#4CAF50" if "成分" in donation_type else "#FF4C4C"
-                new_record = {"id": str(uuid.uuid4()), "title": donation_type, "start": target_date.strftime("%Y-%m-%d"), "location": final_location, "notes": notes, "color": color}
-                st.session_state.history.append(new_record)
+                new_record = {"id": str(uuid.uuid4()), "title": donation_type, "start": target_date.strftime("%Y-%m-%d"), "date_obj": target_date, "location": final_location, "notes": notes, "color": color}
+                st.session_state.history[new_record["id"]] = new_record
+                bisect.insort(st.session_state.history_sorted, new_record, key=lambda r: r["start"])
+                st.session_state.history_version += 1
+                save_history()
 
     def show_edit_form(record):
         st.sidebar.markdown("### 記録の編集")
@@ -183,33 +272,44 @@ def render_calendar_view():
                     return
                 
                 new_color = "#4CAF50" if "成分" in donation_type else "#FF4C4C"
-                st.session_state.history = [r for r in st.session_state.history if r["id"] != record["id"]]
                 record.update({"title": donation_type, "location": final_location, "notes": notes, "color": new_color})
-                st.session_state.history.append(record)
+                st.session_state.history[record["id"]] = record
+                st.session_state.history_version += 1
+                save_history()
                 st.rerun()
             if c2.form_submit_button("削除", type="primary"):
-                st.session_state.history = [r for r in st.session_state.history if r["id"] != record["id"]]
+                del st.session_state.history[record["id"]]
+                st.session_state.history_sorted.remove(record)
+                st.session_state.history_version += 1
+                save_history()
                 st.rerun()
 
-    state = calendar(events=st.session_state.history, options={
+    # "date_obj" is an internal field and not JSON-serializable; keep it out of the component args.
+    events = [{k: v for k, v in r.items() if k != "date_obj"} for r in st.session_state.history.values()]
+    state = calendar(events=events, options={
         "initialDate": st.session_state.calendar_view_date,
         "timeZone": "local", "headerToolbar": {"left": "prev,next today", "center": "title", "right": "dayGridMonth,listYear"},
         "initialView": "dayGridMonth", "selectable": True
-    }, custom_css=".fc-event-past { opacity: 0.8; } .fc-event-title { font-weight: 700; }", key=str(st.session_state.history))
+    }, custom_css=".fc-event-past { opacity: 0.8; } .fc-event-title { font-weight: 700; }", key=f"cal-{st.session_state.history_version}")
 
     if state.get("datesSet"): st.session_state.calendar_view_date = state["datesSet"]["start"]
-    if state.get("dateClick"): 
+    # Reruns without a click payload and without a history change (e.g. month
+    # navigation) have nothing left to render below the calendar. When a click
+    # is pending the sidebar form must be rebuilt, so never short-circuit then.
+    if (not state.get("dateClick") and not state.get("eventClick")
+            and st.session_state.get("last_rendered_version") == st.session_state.history_version):
+        st.stop()
+    st.session_state.last_rendered_version = st.session_state.history_version
+    if state.get("dateClick"):
         # Final Fix for Timezone: Convert UTC date from calendar to JST explicitly.
         dt_obj_utc = datetime.datetime.fromisoformat(state["dateClick"]["date"].replace('Z', '+00:00'))
-        jst = pytz.timezone('Asia/Tokyo')
-        dt_obj_jst = dt_obj_utc.astimezone(jst)
-        actual_date = dt_obj_jst.date()
+        actual_date = dt_obj_utc.astimezone(JST).date()
 
         st.session_state.calendar_view_date = actual_date.strftime("%Y-%m-01")
-        availability = check_availability(actual_date, st.session_state.history, gender, birthday)
+        availability = check_availability(actual_date, st.session_state.history_sorted, gender, birthday)
         show_form(actual_date, availability)
-    if state.get("eventClick"): 
-        event = next((e for e in st.session_state.history if e["id"] == state["eventClick"]["event"]["id"]), None)
+    if state.get("eventClick"):
+        event = st.session_state.history.get(state["eventClick"]["event"]["id"])
         if event: show_edit_form(event)
 
 def render_map_view():
@@ -218,19 +318,21 @@ def render_map_view():
     if locations_df.empty:
         return
 
-    visited_locations_counts = Counter(r["location"] for r in st.session_state.history if r.get("location"))
-    
-    locations_df["visited"] = locations_df["name"].apply(lambda name: name in visited_locations_counts)
-    locations_df["donation_count"] = locations_df["name"].apply(lambda name: visited_locations_counts.get(name, 0))
+    visited_locations_counts = Counter(r["location"] for r in st.session_state.history.values() if r.get("location"))
     
+    counts = locations_df["name"].map(visited_locations_counts).fillna(0).astype(int)
+    locations_df["donation_count"] = counts
+    locations_df["visited"] = counts > 0
+
     VISITED_COLOR = "#4CAF50" # Green
     UNVISITED_COLOR = "#FF4C4C" # Red
-    locations_df["color"] = locations_df["visited"].apply(lambda v: VISITED_COLOR if v else UNVISITED_COLOR)
+    locations_df["color"] = np.where(locations_df["visited"], VISITED_COLOR, UNVISITED_COLOR)
 
     st.map(locations_df, latitude="latitude", longitude="longitude", color="color")
 
     st.markdown("### 全国制覇状況")
     prefecture_stats = locations_df.groupby("prefecture")["visited"].agg(['sum', 'count']).rename(columns={'sum': 'visited', 'count': 'total'})
+    rooms_by_pref = prefecture_rooms(locations_df)
 
     def create_progress_bar(progress, color):
         return f"""
@@ -240,38 +342,35 @@ def render_map_view():
         </div>
         """
 
-    for region, prefectures_in_region in REGIONS.items():
+    for region, prefectures_in_region in regions_present(locations_df).items():
         with st.expander(f"📍 {region}"):
             for pref in prefectures_in_region:
-                if pref in prefecture_stats.index:
-                    stats = prefecture_stats.loc[pref]
-                    total = int(stats['total'])
-                    visited = int(stats['visited'])
-                    progress = visited / total if total > 0 else 0
-
-                    if progress == 0:
-                        bar_color = UNVISITED_COLOR
-                    elif progress == 1:
-                        bar_color = VISITED_COLOR
-                    else:
-                        bar_color = "#FFC107"  # Yellow
-
-                    st.markdown(f"#### {pref}")
-                    st.markdown(create_progress_bar(progress, bar_color), unsafe_allow_html=True)
-                    st.caption(f"{visited} / {total}")
-
-                    pref_df = locations_df[locations_df["prefecture"] == pref]
-                    for _, room in pref_df.iterrows():
-                        count = room["donation_count"]
-                        if room["visited"]:
-                            st.markdown(f"- ✅ **{room['name']}** ({count}回)")
-                        else:
-                            st.markdown(f"- ❌ {room['name']}")
+                stats = prefecture_stats.loc[pref]
+                total = int(stats['total'])
+                visited = int(stats['visited'])
+                progress = visited / total if total > 0 else 0
+
+                if progress == 0:
+                    bar_color = UNVISITED_COLOR
+                elif progress == 1:
+                    bar_color = VISITED_COLOR
+                else:
+                    bar_color = "#FFC107"  # Yellow
+
+                st.markdown(f"#### {pref}")
+                st.markdown(create_progress_bar(progress, bar_color), unsafe_allow_html=True)
+                st.caption(f"{visited} / {total}")
+
+                # One markdown element per prefecture instead of one per
+                # room keeps the frontend message count down.
+                lines = []
+                for name in rooms_by_pref.get(pref, []):
+                    count = visited_locations_counts.get(name, 0)
+                    lines.append(f"- ✅ **{name}** ({count}回)" if count else f"- ❌ {name}")
+                st.markdown("\n".join(lines))
 
 # --- Main App Router ---
 if app_mode == "カレンダー":
     render_calendar_view()
 elif app_mode == "献血マップ":
     render_map_view()
-elif app_mode == "献血マップ":
-    render_map_view()